@@ -1,4 +1,115 @@
 import os
+import re
+from bisect import bisect_left
+from functools import lru_cache
+
+_SNIPPET_TOKEN = re.compile(rb'//\[(\S*)|//\]')
+
+
+@lru_cache(maxsize=None)
+def _dir_entries(directory: str) -> frozenset:
+    """
+    List the entries of a directory once, so looking up files in the
+    same few directories does not stat them on every macro call.
+    """
+    try:
+        with os.scandir(directory) as it:
+            return frozenset(entry.name for entry in it)
+    except OSError:
+        return frozenset()
+
+
+def _exists(abs_path: str) -> bool:
+    """
+    Check if a file exists using the cached directory listings.
+    """
+    directory, name = os.path.split(abs_path)
+    return name in _dir_entries(directory)
+
+
+@lru_cache(maxsize=None)
+def _resolve_path(docs_dir: str, filename: str) -> str:
+    """
+    Find the file a snippet refers to, looking in the docs, root, and
+    examples directories. Returns an empty string if the file is not found.
+    """
+    abs_docs_path = os.path.abspath(os.path.join(docs_dir, filename))
+    abs_root_path = os.path.abspath(os.path.join(docs_dir, "..", filename))
+    abs_examples_path = os.path.abspath(os.path.join(docs_dir, "../examples/", filename))
+    if _exists(abs_docs_path):
+        return abs_docs_path
+    elif _exists(abs_root_path):
+        return abs_root_path
+    elif _exists(abs_examples_path):
+        return abs_examples_path
+    return ''
+
+
+@lru_cache(maxsize=None)
+def _read_file(abs_path: str) -> bytes:
+    """
+    Read the raw contents of a file, so pages referring to the same source
+    file many times only read it once. Snippets are located in the bytes
+    and only the extracted text is decoded.
+    """
+    with open(abs_path, "rb") as f:
+        return f.read()
+
+
+@lru_cache(maxsize=None)
+def _snippet_index(abs_path: str):
+    """
+    Index all snippets in a file in a single pass over its contents.
+    Returns a dict mapping each snippet name to its (start, end) positions.
+    """
+    contents = _read_file(abs_path)
+    starts = {}
+    ends = []
+    for m in _SNIPPET_TOKEN.finditer(contents):
+        name = m.group(1)
+        if name is None:
+            ends.append(m.start())
+        else:
+            name = name.decode("utf-8")
+            if name not in starts:
+                starts[name] = m.start()
+
+    index = {}
+    for name, start_pos in starts.items():
+        i = bisect_left(ends, start_pos)
+        if i != len(ends):
+            index[name] = (start_pos, ends[i])
+    return index
+
+
+@lru_cache(maxsize=None)
+def _find_snippet(abs_path: str, snippet: str):
+    """
+    Find a snippet in a file and return its lines, header, and indent size.
+    Returns None if the snippet is not found.
+    """
+    pos = _snippet_index(abs_path).get(snippet)
+    if pos is None:
+        return None
+    start_pos, end_pos = pos
+    data = memoryview(_read_file(abs_path))
+    contents = str(data[(start_pos + 3 + len(snippet.encode("utf-8"))):(end_pos - 3)], "utf-8")
+
+    # Identify snippet header
+    content_lines = contents.splitlines()
+    first_line = content_lines[0]
+    header = ''
+    if not first_line.isspace() and not len(first_line) == 0:
+        header = first_line.strip()
+
+    # Identify indent
+    indent_size = 20
+    for line in content_lines[1:]:
+        if not line.isspace() and not len(line) == 0:
+            first_char_pos = len(line) - len(line.lstrip())
+            indent_size = min(indent_size, first_char_pos)
+    return content_lines, header, indent_size
+
 
 def declare_variables(variables, macro):
     @macro
@@ -15,65 +126,27 @@ def declare_variables(variables, macro):
         docs_dir = variables.get("docs_dir", "docs")
 
         # Look for file
-        abs_docs_path = os.path.abspath(os.path.join(docs_dir, filename))
-        abs_root_path = os.path.abspath(os.path.join(docs_dir, "..", filename))
-        abs_examples_path = os.path.abspath(os.path.join(docs_dir, "../examples/", filename))
-        abs_path = ''
-        if os.path.exists(abs_docs_path):
-            abs_path = abs_docs_path
-        elif os.path.exists(abs_root_path):
-            abs_path = abs_root_path
-        elif os.path.exists(abs_examples_path):
-            abs_path = abs_examples_path
+        abs_path = _resolve_path(docs_dir, filename)
 
         # File not found
-        if not os.path.exists(abs_path):
+        if not abs_path:
             return f"""<b>File not found: {filename}</b>"""
 
         # Read snippet from file
-        with open(abs_path, "r") as f:
-            if not snippet:
-                return (
-                    f"""```{language}\n{f.read()}\n```"""
-                )
-            else:
-                # Extract the snippet
-                contents = f.read()
-                start_pos = contents.find('//[' + snippet)
-                if start_pos == -1:
-                    return f"""<b>Snippet {snippet} not found in {filename}</b>"""
-                end_pos = contents.find('//]', start_pos)
-                if end_pos == -1:
-                    return f"""<b>Snippet {snippet} not found in {filename}</b>"""
-                contents = contents[(start_pos + 3 + len(snippet)):(end_pos - 3)]
-
-                # Identify snippet header
-                content_lines = contents.splitlines()
-                first_line = content_lines[0]
-                header = ''
-                if not first_line.isspace() and not len(first_line) == 0:
-                    header = first_line.strip()
-
-                # Identify indent
-                indent_size = 20
-                for line in content_lines[1:]:
-                    if not line.isspace() and not len(line) == 0:
-                        first_char_pos = len(line) - len(line.lstrip())
-                        indent_size = min(indent_size, first_char_pos)
-
-                # Construct snippet
-                contents = ''
-                if len(header) != 0:
-                    contents += '=== "' + header + '"\n\n    '
-                contents += '```' + language
-                if len(content_lines) > 10:
-                    contents += ' linenums="1" '
-                contents += '\n'
-                for line in content_lines[1:]:
-                    if len(header) != 0:
-                        contents += '    '
-                    contents += line[indent_size:] + '\n'
-                if len(header) != 0:
-                    contents += '    '
-                contents += '```\n'
-                return contents
+        if not snippet:
+            return (
+                f"""```{language}\n{_read_file(abs_path).decode("utf-8")}\n```"""
+            )
+
+        # Extract the snippet
+        found = _find_snippet(abs_path, snippet)
+        if found is None:
+            return f"""<b>Snippet {snippet} not found in {filename}</b>"""
+        content_lines, header, indent_size = found
+
+        # Construct snippet
+        prefix = '    ' if header else ''
+        linenums = ' linenums="1" ' if len(content_lines) > 10 else ''
+        body = ''.join(f"{prefix}{line[indent_size:]}\n" for line in content_lines[1:])
+        tab = f'=== "{header}"\n\n    ' if header else ''
+        return f"{tab}```{language}{linenums}\n{body}{prefix}```\n"
@@ -19,62 +19,68 @@
 
 import gdb
 import re
-import sys
 
 import itertools
 from bisect import bisect_left
 
-# Helpers
-have_python_2 = (sys.version_info[0] == 2)
-have_python_3 = (sys.version_info[0] == 3)
-
-if have_python_3:
-    xrange = range
-    intptr = int
-elif have_python_2:
-    intptr = long
-
-def split_parameter_pack(typename):
-    """Split a string represending a comma-separated c++ parameter pack into a list of strings of element types"""
-
-    unmatched = 0
-    length = len(typename)
-    b = e = 0
-    while e < length:
-        c = typename[e]
-        if c == ',' and unmatched == 0:
-            yield typename[b:e].strip()
-            b = e = e + 1
-        elif c == '<':
-            unmatched += 1
-        elif c == '>':
-            unmatched -= 1
-        e += 1
-    yield typename[b:e].strip()
+# Regular expressions used to match the futures types, compiled once on import
+_DISPATCH_RE = re.compile(
+    r'^futures::detail::(?:'
+    r'(future_state)<.*>(::type_id)?$'
+    r'|(maybe_empty)<.*>$'
+    r')')
+_DISPATCH_MATCH = _DISPATCH_RE.match
+_MAYBE_EMPTY_RE = re.compile(r'^futures::detail::maybe_empty<(.*),\s*([^,<>]+?)\s*,\s*(true|false)\s*>$')
+_MAYBE_EMPTY_MATCH = _MAYBE_EMPTY_RE.match
+
+# Variant types of future states with their unqualified and resolved names,
+# keyed on (state typename, type index)
+_VARIANT_TYPE_CACHE = {}
 
+# Helpers
 def strip_qualifiers(typename):
     """Remove const/volatile qualifiers, references, and pointers of a type"""
-    qps = []
-
-    try:
-        while True:
-            typename = typename.rstrip()
-            qual = next(q for q in ['&', '*', 'const', 'volatile'] if typename.endswith(q))
-            typename = typename[:-len(qual)]
-            qps.append(qual)
-    except StopIteration:
-        pass
-
-    try:
-        while True:
-            typename = typename.lstrip()
-            qual = next(q for q in ['const', 'volatile'] if typename.startswith(q))
-            typename = typename[len(qual):]
-            qps.append(qual)
-    except StopIteration:
-        pass
-
-    return typename, qps[::-1]
+    right = []
+    while True:
+        typename = typename.rstrip()
+        if typename.endswith('&'):
+            right.append('&')
+            typename = typename[:-1]
+        elif typename.endswith('*'):
+            right.append('*')
+            typename = typename[:-1]
+        elif typename.endswith('const'):
+            right.append('const')
+            typename = typename[:-5]
+        elif typename.endswith('volatile'):
+            right.append('volatile')
+            typename = typename[:-8]
+        else:
+            break
+
+    left = []
+    while True:
+        typename = typename.lstrip()
+        if typename.startswith('const'):
+            left.append('const')
+            typename = typename[5:]
+        elif typename.startswith('volatile'):
+            left.append('volatile')
+            typename = typename[8:]
+        else:
+            break
+
+    # Qualifiers were collected from the outside in
+    left.reverse()
+    right.reverse()
+    return typename, left + right
+
+# Functions applying each qualifier to a gdb.Type
+_QUALIFIER_OPS = {
+    '*': lambda t: t.pointer(),
+    '&': lambda t: t.reference(),
+    'const': lambda t: t.const(),
+}
 
 def apply_qualifiers(t, qs):
     """Apply the given sequence of references, and pointers to a gdb.Type.
@@ -82,12 +88,9 @@ def apply_qualifiers(t, qs):
        printing. Also it is not possible to make a const+volatile qualified
        type in gdb."""
     for q in qs:
-        if q == '*':
-            t = t.pointer()
-        elif q == '&':
-            t = t.reference()
-        elif q == 'const':
-            t = t.const()
+        op = _QUALIFIER_OPS.get(q)
+        if op is not None:
+            t = op(t)
     return t
 
 def reinterpret_cast(value, target_type):
@@ -96,36 +99,36 @@ def reinterpret_cast(value, target_type):
 class FutureStateTypeIDPrinter:
     "Pretty Printer for futures::detail::future_state<...>::type_id"
 
+    type_names = (
+        'empty',
+        'direct_storage',
+        'shared_storage',
+        'inline_state',
+        'shared_state',
+    )
+
     def __init__(self, value):
         self.value = value
 
     def to_string(self):
-        enum_type = self.value.type
-        if self.value == 0:
-            return 'empty'
-        if self.value == 1:
-            return 'direct_storage'
-        if self.value == 2:
-            return 'shared_storage'
-        if self.value == 3:
-            return 'inline_state'
-        if self.value == 4:
-            return 'shared_state'
+        type_index = int(self.value)
+        if 0 <= type_index < len(FutureStateTypeIDPrinter.type_names):
+            return FutureStateTypeIDPrinter.type_names[type_index]
         return 'invalid type'
 
 
 class MaybeEmptyPrinter:
     "Pretty Printer for futures::detail::maybe_empty<...>"
 
-    regex = re.compile('^futures::detail::maybe_empty<(.*),(.*),(.*)>$')
-
-    def __init__(self, value):
+    def __init__(self, value, m=None):
         self.value = value
         self.type_str = underlying_typename(value)
-        m = MaybeEmptyPrinter.regex.search(self.type_str)
+        if m is None:
+            m = _MAYBE_EMPTY_MATCH(self.type_str)
+        assert m is not None, 'Unrecognized maybe_empty type: ' + self.type_str
         self.maybe_empty_type = m.group(1)
         self.maybe_empty_index = m.group(2)
-        self.is_empty = m.group(3).find('true') != -1
+        self.is_empty = m.group(3) == 'true'
 
     def to_string(self):
         if self.is_empty:
@@ -144,66 +147,105 @@ class FutureStatePrinter:
 
     printer_name = 'futures::detail::future_state'
     template_name = 'futures::detail::future_state'
-    regex = re.compile('^futures::detail::future_state<(.*)>$')
+    stored_suffixes = (
+        '::empty_t',
+        '::operation_storage_t',
+        '::shared_storage_t',
+        '::operation_state_t',
+        '::shared_state_t',
+    )
 
     def __init__(self, value):
         self.value = value
+        self._tname = underlying_typename(value)
+        self._type_index = None
+        self._resolved = None
 
     def to_string(self):
-        resolved_type = self.get_variant_type()
-        return '(futures::detail::future_state<...>) type = {}'.format(resolve_type(resolved_type))
+        # Only the cached variant names are needed here, so printing
+        # without children never touches the stored data
+        display_name = self.get_variant()[2]
+        return '(futures::detail::future_state<...>) type = {}'.format(display_name)
+
+    def display_hint(self):
+        return None
 
     def children(self):
-        resolved_type = self.get_variant_type()
-        stored_value = reinterpret_cast(self.value['data_']['data_'], resolved_type)
-        r = str(resolved_type)
-        pos = r.rfind('::')
-        if pos != -1:
-            r = r[pos+2:]
-        yield r, stored_value
+        if self.get_type_index() == 0:
+            # Nothing is stored in an empty state
+            yield 'empty', True
+        else:
+            resolved_type, short_name = self.get_variant()[:2]
+            stored_value = reinterpret_cast(self.value['data_']['data_'], resolved_type)
+            yield short_name, stored_value
         yield 'which', self.value['type_id_']
         yield 'address', self.value['data_']['data_'].address
         # yield 'as_bytes', self.value['data_']['data_']
 
+    def get_type_index(self):
+        """Get the index of the type currently stored in the state"""
+
+        if self._type_index is None:
+            self._type_index = int(self.value['type_id_'])
+        return self._type_index
+
     def get_variant_type(self):
         """Get a gdb.Type of a template argument"""
+        return self.get_variant()[0]
+
+    def get_variant(self):
+        """Get a gdb.Type of a template argument, its unqualified name, and its resolved name"""
 
-        type_index = intptr(self.value['type_id_'])
+        if self._resolved is not None:
+            return self._resolved
+
+        type_index = self.get_type_index()
         assert type_index >= 0, 'Heap backup is not supported'
+        assert type_index < len(FutureStatePrinter.stored_suffixes), 'Invalid type index'
+
+        tname = self._tname
+        key = (tname, type_index)
+        resolved = _VARIANT_TYPE_CACHE.get(key)
+        if resolved is not None:
+            self._resolved = resolved
+            return resolved
 
         # This is a workaround for a GDB issue
         # https://sourceware.org/bugzilla/show_bug.cgi?id=17311.
         # gdb.Type.template_argument() method does not work unless variadic templates
         # are disabled using BOOST_VARIANT_DO_NOT_USE_VARIADIC_TEMPLATES.
-        m = FutureStatePrinter.regex.search(underlying_typename(self.value))
-        [R, OpState] = list(split_parameter_pack(m.group(1)))
+        # The stored types are looked up by name instead, so the template
+        # arguments R and OpState never need to be split from the typename.
 
         # Get current type name
-        stored_type_name = ''
-        if type_index == 0:
-            stored_type_name = underlying_typename(self.value) + '::empty_t'
-        elif type_index == 1:
-            stored_type_name = underlying_typename(self.value) + '::operation_storage_t'
-        elif type_index == 2:
-            stored_type_name = underlying_typename(self.value) + '::shared_storage_t'
-        elif type_index == 3:
-            stored_type_name = underlying_typename(self.value) + '::operation_state_t'
-        elif type_index == 4:
-            stored_type_name = underlying_typename(self.value) + '::shared_state_t'
+        stored_type_name = tname + FutureStatePrinter.stored_suffixes[type_index]
         resolved_type = gdb.lookup_type(stored_type_name)
-        return resolved_type
+        short_name = str(resolved_type)
+        pos = short_name.rfind('::')
+        if pos != -1:
+            short_name = short_name[pos+2:]
+        display_name = str(resolve_type(resolved_type))
+        resolved = (resolved_type, short_name, display_name)
+        _VARIANT_TYPE_CACHE[key] = resolved
+        self._resolved = resolved
+        return resolved
 
 def underlying_typename(val):
     t = val.type
-    t = resolve_type(t)
-    if t is not None:
-        return str(t)
+    rt = resolve_type(t)
+    if rt is not None:
+        return str(rt)
     else:
-        return str(val.type)
+        return str(t)
 
 def resolve_type(t):
     if t.code == gdb.TYPE_CODE_REF:
         t = t.target()
+
+    # Types with a tag (structs, unions, enums) are never typedefs, so only
+    # their qualifiers need to be removed
+    if t.tag is not None:
+        return t.unqualified()
     t = t.unqualified().strip_typedefs()
 
     typename = t.tag
@@ -214,18 +256,47 @@ def resolve_type(t):
 def lookup_function(val):
     "Look-up and return a pretty-printer that can print va."
 
+    # Named types other than typedefs are already in their underlying form,
+    # so most values can be rejected by name without resolving their type.
+    # References and typedefs still need to be resolved.
+    vt = val.type
+    tn = vt.name
+    if tn is not None and vt.code != gdb.TYPE_CODE_TYPEDEF and not tn.startswith('futures::detail::'):
+        return None
+
     t = underlying_typename(val)
-    if t.startswith('futures::detail::future_state'):
-        if t.endswith('::type_id'):
+    m = _DISPATCH_MATCH(t)
+    if m is None:
+        return None
+
+    if m.group(1):
+        if m.group(2):
             return FutureStateTypeIDPrinter(val)
         else:
             return FutureStatePrinter(val)
 
-    if t.startswith('futures::detail::maybe_empty'):
-        return MaybeEmptyPrinter(val)
+    if m.group(3):
+        # Fall back to the default printer for names we cannot parse
+        m = _MAYBE_EMPTY_MATCH(t)
+        if m is None:
+            return None
+        return MaybeEmptyPrinter(val, m)
 
     return None
 
+def invalidate_caches(event=None):
+    "Clear the cached types, which might be stale once symbols are (un)loaded"
+
+    _VARIANT_TYPE_CACHE.clear()
+
+# Keep the caches across steps and only flush them when symbols change.
+# This is connected once, however many objfiles the printers are registered with.
+try:
+    gdb.events.new_objfile.connect(invalidate_caches)
+    gdb.events.clear_objfiles.connect(invalidate_caches)
+except AttributeError:
+    pass
+
 def register_futures_printers(obj):
     "Register futures pretty-printers with objfile Obj"
 